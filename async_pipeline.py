@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# Asyncio versions of manifest generation, verification and copying for high-latency mounts (NFS/SMB).
+# Every blocking filesystem call goes through a LocalFS object on a thread pool so many files are in flight at once.
+import os
+import csv
+import sys
+import shutil
+import asyncio
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import archiver
+
+class LocalFS:
+    """Blocking filesystem calls used by the pipeline. Subclass to inject latency or point at another backend."""
+
+    def listdir(self, path):
+        """returns (dirnames, filenames, walk_dirnames) sorted, like one step of os.walk"""
+        dirnames = []
+        filenames = []
+        walk_dirnames = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirnames.append(entry.name)
+                    if not entry.is_symlink():
+                        walk_dirnames.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+        return sorted(dirnames), sorted(filenames), sorted(walk_dirnames)
+
+    def stat(self, file_path):
+        return os.stat(file_path)
+
+    def exists(self, file_path):
+        return os.path.exists(file_path)
+
+    def calculate_md5(self, file_path, block_size=65536):
+        """Calculate md5 checksum from file path"""
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def copy(self, old_filepath, new_filepath):
+        os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
+        shutil.copy2(old_filepath, new_filepath)
+
+    def move(self, old_filepath, new_filepath):
+        os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
+        shutil.move(old_filepath, new_filepath)
+
+async def run_ordered(items, worker, handle_result, concurrency):
+    """
+    Runs worker over items with bounded concurrency and hands the results to handle_result in item order.
+    At most `concurrency` workers run at once and at most 4 * `concurrency` results wait to be handled,
+    so a slow file holds back the producer instead of letting results pile up.
+    Returns False as soon as handle_result returns False, cancelling the remaining work.
+
+    :param items: async iterable of work items
+    :param worker: coroutine function taking (loop, executor, item)
+    :param handle_result: function taking a result, returns False to stop
+    :param concurrency: integer, max number of items in flight
+    """
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(concurrency)
+    window = asyncio.Semaphore(concurrency * 4)
+    pending = asyncio.Queue()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def run_one(item):
+            async with in_flight:
+                return await worker(loop, executor, item)
+
+        async def produce():
+            async for item in items:
+                await window.acquire()
+                await pending.put(asyncio.ensure_future(run_one(item)))
+            await pending.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                result = await task
+                window.release()
+                if handle_result(result) is False:
+                    return False
+            await producer
+            return True
+        finally:
+            producer.cancel()
+            leftover = [producer]
+            while not pending.empty():
+                task = pending.get_nowait()
+                if task is not None:
+                    task.cancel()
+                    leftover.append(task)
+            await asyncio.gather(*leftover, return_exceptions=True)
+
+class AsyncManifest:
+    def __init__(self, source, concurrency = 32, fs = None):
+        """
+        :param source: string, asset folder to manifest
+        :param concurrency: integer, number of files kept in flight
+        :param fs: LocalFS object used for all blocking calls
+        """
+        self.source = source
+        self.parent_directory = os.path.dirname(self.source)
+        self.output_csv = os.path.join(self.parent_directory, 'file_manifest.csv')
+        self.header = ['File Path', 'Bytes', 'MD5', 'Timestamp']
+        self.concurrency = concurrency
+        self.fs = fs or LocalFS()
+
+    async def walk_files(self, loop, executor):
+        """Yields file paths in the same order as Manifest.generate_file_manifest, one listdir round trip per folder"""
+        stack = [self.source]
+        while stack:
+            dirpath = stack.pop()
+            _, filenames, walk_dirnames = await loop.run_in_executor(executor, self.fs.listdir, dirpath)
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    yield os.path.join(dirpath, filename)
+            stack.extend(os.path.join(dirpath, dirname) for dirname in reversed(walk_dirnames))
+
+    async def get_file_info(self, loop, executor, file_path):
+        """returns ['File Path', 'Bytes', 'MD5', 'Timestamp']"""
+        stat = await loop.run_in_executor(executor, self.fs.stat, file_path)
+        file_md5 = await loop.run_in_executor(executor, self.fs.calculate_md5, file_path)
+        timestamp_str = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+        relative_path = os.path.relpath(file_path, self.source)
+        return relative_path, stat.st_size, file_md5, timestamp_str
+
+    async def generate_file_manifest(self):
+        loop = asyncio.get_running_loop()
+        # The walk gets its own small pool so listing never waits behind hashing
+        with ThreadPoolExecutor(max_workers=1) as walk_executor:
+            file_paths = self.walk_files(loop, walk_executor)
+
+            async def worker(loop, executor, file_path):
+                return await self.get_file_info(loop, executor, file_path)
+
+            with open(self.output_csv, mode='w', newline='') as csv_file:
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(self.header)
+                await run_ordered(file_paths, worker, csv_writer.writerow, self.concurrency)
+
+        return self.output_csv
+
+    async def verify_file_manifest(self, csv_file, expected_header = True):
+        """
+        Params: path to file_manifest.csv
+        Returns True if the manifest is valid
+        """
+        if expected_header:
+            expected_header = self.header
+
+        asset_folder = os.path.join(os.path.dirname(csv_file), 'assets')
+        if not os.path.isdir(asset_folder):
+            if os.path.isfile(os.path.join(os.path.dirname(csv_file), 'pack_index.csv')):
+                return await asyncio.get_running_loop().run_in_executor(None, archiver.verify_file_manifest, csv_file, expected_header)
+            print("No asset folder found.")
+            return False
+
+        with open(csv_file, newline='', encoding='utf-8') as f:
+            csv_reader = csv.reader(f)
+            header = next(csv_reader)  # Skip the header row, checking first
+            if expected_header and expected_header != header:
+                print("Header mismatch found.")
+                return False
+            rows = list(csv.DictReader(f, fieldnames=header))
+
+        async def manifest_rows():
+            for row in rows:
+                yield row
+
+        async def worker(loop, executor, row):
+            file_path = os.path.join(asset_folder, row["File Path"])
+            if not await loop.run_in_executor(executor, self.fs.exists, file_path):
+                return file_path, row["MD5"], None
+            return file_path, row["MD5"], await loop.run_in_executor(executor, self.fs.calculate_md5, file_path)
+
+        def check_result(result):
+            file_path, csv_md5, current_md5 = result
+            if current_md5 is None:
+                print(f'"File missing: "{file_path}')
+                return False
+            if current_md5 != csv_md5:
+                print(f'"MD5 mismatch: "{file_path}')
+                return False
+            return True
+
+        # Results come back in manifest order, so the first failure reported matches Manifest
+        return await run_ordered(manifest_rows(), worker, check_result, self.concurrency)
+
+async def write_data(list_of_rows, asset_path, mode = "copy", concurrency = 32, fs = None):
+    """
+    Copies or moves data with many files in flight
+
+    :param list_of_rows: list containing csv.DictReader rows
+    :param asset_path: string, dir to write the files to
+    :param mode: 'copy' or 'move'
+    """
+    fs = fs or LocalFS()
+    total_bytes = [0]
+
+    async def manifest_rows():
+        for row in list_of_rows:
+            yield row
+
+    async def worker(loop, executor, row):
+        old_filepath = os.path.join(row["Origin"], row["File Path"])
+        new_filepath = os.path.join(asset_path, row["File Path"])
+        await loop.run_in_executor(executor, fs.move if mode == "move" else fs.copy, old_filepath, new_filepath)
+        return old_filepath, new_filepath, int(row["Bytes"])
+
+    def report(result):
+        old_filepath, new_filepath, size = result
+        print(f"{old_filepath}\n-->{new_filepath}")
+        total_bytes[0] += size
+
+    await run_ordered(manifest_rows(), worker, report, concurrency)
+    print(f"Total GB = {round(total_bytes[0] / 1000 ** 3,2)}")
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python async_pipeline.py <asset folder or manifest> (optional) --concurrency <files in flight>")
+        sys.exit(1)
+    else:
+        concurrency = 32
+        if "--concurrency" in sys.argv:
+            concurrency = int(sys.argv[sys.argv.index("--concurrency") + 1])
+        for i in sys.argv:
+            if os.path.isfile(i) and i.endswith('file_manifest.csv'):
+                print(f"Verifying manifest: {i}")
+                this_manifest = AsyncManifest(i, concurrency)
+                result = asyncio.run(this_manifest.verify_file_manifest(i, expected_header = False))
+                print(f"Manifest valid: {result}")
+            if os.path.isdir(i) and i.endswith('assets'):
+                this_manifest = AsyncManifest(i, concurrency)
+                asyncio.run(this_manifest.generate_file_manifest())
+
+if __name__ == "__main__":
+    main()
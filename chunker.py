@@ -6,11 +6,13 @@ import time
 import os
 import sys
 import pickle
+from profiler import StageProfiler
 
 class Chunker:
-    def __init__(self, input_dir, output_dir, seen_md5_pkl = "md5.pkl", chunk_size_gb = 500):
+    def __init__(self, input_dir, output_dir, seen_md5_pkl = "md5.pkl", chunk_size_gb = 500, profile = None):
         self.input_dir = input_dir
         self.output_dir = output_dir
+        self.profiler = StageProfiler(profile, "chunker")
         self.seen_md5 = set()
         self.seen_md5_pkl = seen_md5_pkl
         self.init_time = time.strftime("%y%m%d%H%M%S")
@@ -29,7 +31,8 @@ class Chunker:
         
         if os.path.exists(self.seen_md5_pkl):
             print(f"skipping duplicates in md5 file: {self.seen_md5_pkl}")
-            self.seen_md5 = load_pkl(seen_md5_pkl)
+            with self.profiler.stage("load"):
+                self.seen_md5 = load_pkl(seen_md5_pkl)
         else:
             print(f"file not found: {seen_md5_pkl}")
 
@@ -41,9 +44,11 @@ class Chunker:
         prefix_chunks = f'chunk_{self.init_time}_'
         prefix_duplicates = f'duplicates_{self.init_time}_'
 
-        self.write_csv_chunks(chunks,prefix_chunks)
-        self.write_csv_chunks(duplicates,prefix_duplicates)
-        self.dump_md5_pkl()
+        with self.profiler.stage("write"):
+            self.write_csv_chunks(chunks,prefix_chunks)
+            self.write_csv_chunks(duplicates,prefix_duplicates)
+            self.dump_md5_pkl()
+        self.profiler.report()
 
     def dump_md5_pkl(self):
         filepath = f'{self.output_dir}/md5.pkl'
@@ -79,27 +84,29 @@ class Chunker:
             with open(csv_file, newline='', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
                 
-                for row in reader:
-                    row["Origin"] = csv_file
-                    file_path = row["File Path"]
-                    size = int(row["Bytes"])
-                    md5 = row["MD5"]
-                    timestamp = row["Timestamp"]
-
-                    # Check for duplicates
-                    if md5 in self.seen_md5:
-                        duplicates.append(row)
-                        continue
-                    self.seen_md5.add(md5)
-
-                    # If adding this file exceeds chunk size, start a new chunk
-                    if current_size + size > self.chunk_size:
-                        chunks.append(current_chunk)
-                        current_chunk = []
-                        current_size = 0
-
-                    current_chunk.append(row)
-                    current_size += size
+                # Parsing each row is its own stage inside the grouping of the csv
+                with self.profiler.stage("group"):
+                    for row in self.profiler.iterate("parse", reader):
+                        row["Origin"] = csv_file
+                        file_path = row["File Path"]
+                        size = int(row["Bytes"])
+                        md5 = row["MD5"]
+                        timestamp = row["Timestamp"]
+
+                        # Check for duplicates
+                        if md5 in self.seen_md5:
+                            duplicates.append(row)
+                            continue
+                        self.seen_md5.add(md5)
+
+                        # If adding this file exceeds chunk size, start a new chunk
+                        if current_size + size > self.chunk_size:
+                            chunks.append(current_chunk)
+                            current_chunk = []
+                            current_size = 0
+
+                        current_chunk.append(row)
+                        current_size += size
 
         # Add the last chunk if not empty
         if current_chunk:
@@ -153,11 +160,19 @@ class Chunker:
         return chunks, [oversized], [duplicates]
 
 def main():
-    if len(sys.argv) < 3:
-        print("Usage: python chunker.py <input directory> <output directory> (optional) <md5 pkl path> <size in bytes>")
+    args = sys.argv[1:]
+    profile = None
+    # --profile needs a value after it
+    if "--profile" in args[:-1]:
+        index = args.index("--profile")
+        profile = args[index + 1]
+        del args[index:index + 2]
+
+    if len(args) < 2 or "--profile" in args:
+        print("Usage: python chunker.py <input directory> <output directory> (optional) <md5 pkl path> <size in bytes> --profile <report dir>")
         sys.exit(1)
 
-    main_chunker = Chunker(*sys.argv[1:])
+    main_chunker = Chunker(*args, profile=profile)
     main_chunker.run()
 
 if __name__ == "__main__":
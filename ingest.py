@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# Long-running daemon for the 01_Landing -> 02_ToChunk -> 03_Chunking -> 04_Staging pipeline.
+# 05_Archive is left to the operator.
+import os
+import csv
+import sys
+import time
+import queue
+import pickle
+import shutil
+import threading
+from manifest import Manifest
+from archiver import Archiver, verify_file_manifest, write_data, load_pack_index
+
+STAGES = {
+    "Landing": "01_Landing",
+    "ToChunk": "02_ToChunk",
+    "Chunking": "03_Chunking",
+    "Staging": "04_Staging",
+    "Archive": "05_Archive",
+}
+
+class IngestDaemon:
+    def __init__(self, root, bucket_size = 50 * 1000 ** 3, prefix = "BDL-", settle_seconds = 60, poll_interval = 5, manifest_workers = 2, staging_workers = 2, state_pkl = None, **archiver_kwargs):
+        """
+        Watches the stage folders under root and moves asset folders through them
+
+        :param root: string, folder containing 01_Landing ... 05_Archive
+        :param bucket_size: integer, size of each bucket in bytes
+        :param prefix: string, prefix for the buckets
+        :param settle_seconds: number, how long an asset folder must stay unchanged before it is manifested
+        :param poll_interval: number, seconds between scans of the stage folders
+        :param manifest_workers: integer, threads generating manifests
+        :param staging_workers: integer, threads verifying buckets and moving them to staging
+        :param state_pkl: string, file path of the persistent dedupe state (defaults to root/ingest_state.pkl)
+        :param archiver_kwargs: passed on to Archiver, e.g. layout or compression
+        """
+        self.root = root
+        self.directories = {name: os.path.join(root, folder) for name, folder in STAGES.items()}
+        self.bucket_size = bucket_size
+        self.prefix = prefix
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.manifest_workers = manifest_workers
+        self.staging_workers = staging_workers
+        self.state_pkl = state_pkl or os.path.join(root, "ingest_state.pkl")
+        self.archiver_kwargs = archiver_kwargs
+
+        for path in self.directories.values():
+            os.makedirs(path, exist_ok=True)
+
+        self.state = {"seen_md5": set(), "next_bucket": 1, "chunked": set(), "in_progress": {}}
+        if os.path.exists(self.state_pkl):
+            print(f"Loading ingest state: {self.state_pkl}")
+            with open(self.state_pkl, "rb") as f:
+                self.state.update(pickle.load(f))
+
+        self.manifest_queue = queue.Queue()
+        self.chunk_queue = queue.Queue()
+        self.staging_queue = queue.Queue()
+        self.snapshots = {}
+        self.queued = set()
+        self.unverified = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def dump_state(self):
+        """Writes the dedupe state next to itself first so a crash never leaves a half written pickle"""
+        temp_pkl = f"{self.state_pkl}.tmp"
+        with open(temp_pkl, "wb") as f:
+            pickle.dump(self.state, f)
+        os.replace(temp_pkl, self.state_pkl)
+
+    def snapshot(self, folder_path):
+        """returns (file count, total bytes, latest mtime) for a folder"""
+        file_count = 0
+        total_bytes = 0
+        latest_mtime = 0
+        for dirpath, dirnames, filenames in os.walk(folder_path):
+            for filename in filenames:
+                stat = os.stat(os.path.join(dirpath, filename))
+                file_count += 1
+                total_bytes += stat.st_size
+                latest_mtime = max(latest_mtime, stat.st_mtime)
+        return file_count, total_bytes, latest_mtime
+
+    def poll(self):
+        """
+        Scans Landing for settled asset folders, ToChunk for manifested folders that are not chunked yet
+        and Chunking for finished buckets left behind when the daemon stopped before staging them
+        """
+        now = time.time()
+        for name in sorted(os.listdir(self.directories["Landing"])):
+            folder_path = os.path.join(self.directories["Landing"], name)
+            if name.startswith('.') or not os.path.isdir(os.path.join(folder_path, "assets")):
+                continue
+            with self.lock:
+                if ("Landing", name) in self.queued:
+                    continue
+            try:
+                snapshot = self.snapshot(folder_path)
+            except OSError:
+                continue # Files are still being moved in
+            previous = self.snapshots.get(name)
+            if previous is None or previous[0] != snapshot:
+                self.snapshots[name] = (snapshot, now)
+                if self.settle_seconds > 0:
+                    continue
+            elif now - previous[1] < self.settle_seconds:
+                continue
+            del self.snapshots[name]
+            with self.lock:
+                self.queued.add(("Landing", name))
+            self.manifest_queue.put(name)
+
+        for name in sorted(os.listdir(self.directories["ToChunk"])):
+            folder_path = os.path.join(self.directories["ToChunk"], name)
+            if not os.path.isfile(os.path.join(folder_path, "file_manifest.csv")):
+                continue
+            with self.lock:
+                if name in self.state["chunked"] or ("ToChunk", name) in self.queued:
+                    continue
+                self.queued.add(("ToChunk", name))
+            self.chunk_queue.put(name)
+
+        # Buckets of a reserved range, or numbered past it, may still be being written
+        with self.lock:
+            next_bucket = self.state["next_bucket"]
+            writing = {i for reserved in self.state["in_progress"].values() for i in range(reserved["Start"], reserved["Start"] + reserved["Count"])}
+        for bucket in sorted(os.listdir(self.directories["Chunking"])):
+            bucket_num = bucket[len(self.prefix):]
+            if not bucket.startswith(self.prefix) or not bucket_num.isdigit():
+                continue
+            if int(bucket_num) >= next_bucket or int(bucket_num) in writing:
+                continue
+            if bucket in self.unverified:
+                continue # Verified once already, left for the operator until the daemon restarts
+            if os.path.isfile(os.path.join(self.directories["Chunking"], bucket, "file_manifest.csv")):
+                self.queue_bucket(bucket)
+
+    def queue_bucket(self, bucket):
+        """Hands a finished bucket to the staging workers unless it is already waiting"""
+        with self.lock:
+            if ("Chunking", bucket) in self.queued:
+                return
+            self.queued.add(("Chunking", bucket))
+        self.staging_queue.put(bucket)
+
+    def manifest_folder(self, name):
+        """Manifests a settled Landing folder and hands it on to ToChunk"""
+        landing_path = os.path.join(self.directories["Landing"], name)
+        to_chunk_path = os.path.join(self.directories["ToChunk"], name)
+        try:
+            if os.path.exists(to_chunk_path):
+                print(f"Already in {STAGES['ToChunk']}, leaving in place: {landing_path}")
+                return
+            print(f"Manifesting: {landing_path}")
+            Manifest(os.path.join(landing_path, "assets")).generate_file_manifest()
+            with self.lock:
+                shutil.move(landing_path, to_chunk_path)
+                self.queued.add(("ToChunk", name))
+            self.chunk_queue.put(name)
+        finally:
+            # A failed folder is picked up again once it settles
+            with self.lock:
+                self.queued.discard(("Landing", name))
+
+    def chunk_folder(self, name):
+        """
+        Chunks a manifested folder against the persistent dedupe state.
+        Bucket numbers are reserved and saved before any data moves, and the folder's md5s only join
+        seen_md5 once every bucket is written, so a failed or interrupted folder can simply be run again.
+        """
+        folder_path = os.path.join(self.directories["ToChunk"], name)
+        try:
+            reserved = self.state["in_progress"].get(name)
+            if reserved is None:
+                print(f"Chunking: {folder_path}")
+                archiver = self.plan_buckets(name)
+            else:
+                print(f"Resuming: {folder_path}")
+                archiver = self.load_buckets(name, reserved)
+
+            for i, chunk in enumerate(archiver.groups, archiver.start_num):
+                if self.write_bucket(archiver, i, chunk):
+                    self.queue_bucket(archiver.bucket_name(i))
+
+            with self.lock:
+                for chunk in archiver.groups:
+                    self.state["seen_md5"].update(row["MD5"] for row in chunk)
+                self.state["chunked"].add(name)
+                del self.state["in_progress"][name]
+                self.dump_state()
+        finally:
+            with self.lock:
+                self.queued.discard(("ToChunk", name))
+
+    def new_archiver(self, name, start_num, seen_md5):
+        folder_path = os.path.join(self.directories["ToChunk"], name)
+        return Archiver([os.path.join(folder_path, "file_manifest.csv")], output_dir=self.directories["Chunking"], bucket_size=self.bucket_size, start_num=start_num, dedupe=True, prefix=self.prefix, seen_md5=seen_md5, **self.archiver_kwargs)
+
+    def plan_buckets(self, name):
+        """Groups a folder, writes every bucket manifest and saves the reserved bucket range"""
+        folder_path = os.path.join(self.directories["ToChunk"], name)
+        # Group against a copy, seen_md5 only changes once the buckets are written
+        archiver = self.new_archiver(name, self.state["next_bucket"], set(self.state["seen_md5"]))
+        archiver.groups, archiver.dupes, archiver.oversized = archiver.group_files()
+
+        # Duplicates and oversized files stay behind in ToChunk for the operator
+        if archiver.dupes:
+            archiver.write_csv(os.path.join(folder_path, "duplicates.csv"), archiver.dupes)
+        if archiver.oversized:
+            archiver.write_csv(os.path.join(folder_path, "oversized.csv"), archiver.oversized)
+
+        # The bucket manifests are the plan a resumed run reads back
+        for i, chunk in enumerate(archiver.groups, archiver.start_num):
+            bucket_path = os.path.join(self.directories["Chunking"], archiver.bucket_name(i))
+            os.makedirs(bucket_path, exist_ok=True)
+            archiver.write_csv(os.path.join(bucket_path, "file_manifest.csv"), chunk)
+
+        with self.lock:
+            self.state["next_bucket"] = archiver.start_num + len(archiver.groups)
+            self.state["in_progress"][name] = {"Start": archiver.start_num, "Count": len(archiver.groups)}
+            self.dump_state()
+        return archiver
+
+    def load_buckets(self, name, reserved):
+        """Reads back the bucket manifests of a reserved range, from Chunking or, if already staged, Staging"""
+        archiver = self.new_archiver(name, reserved["Start"], set(self.state["seen_md5"]))
+        origin = os.path.join(self.directories["ToChunk"], name, "assets")
+        archiver.groups = []
+        for i in range(reserved["Start"], reserved["Start"] + reserved["Count"]):
+            bucket_manifest = os.path.join(self.directories["Chunking"], archiver.bucket_name(i), "file_manifest.csv")
+            if not os.path.isfile(bucket_manifest):
+                bucket_manifest = os.path.join(self.directories["Staging"], archiver.bucket_name(i), "file_manifest.csv")
+            with open(bucket_manifest, newline='', encoding='utf-8') as f:
+                archiver.groups.append([dict(row, Origin=origin) for row in csv.DictReader(f)])
+        return archiver
+
+    def write_bucket(self, archiver, i, chunk):
+        """
+        Writes a bucket, picking up where an interrupted run left off.
+        Rows that are no longer in their Origin must already be in the bucket.
+        Returns False if the bucket was already staged.
+        """
+        bucket = archiver.bucket_name(i)
+        if os.path.exists(os.path.join(self.directories["Staging"], bucket)):
+            return False
+        bucket_path = os.path.join(self.directories["Chunking"], bucket)
+        moved = [row for row in chunk if not os.path.exists(os.path.join(row["Origin"], row["File Path"]))]
+        if not moved or archiver.mode != "move":
+            archiver.write_bucket(i, chunk, self.directories["Chunking"])
+            return True
+
+        if archiver.layout == "pack":
+            # Sources are only removed after the pack index is complete
+            pack_index = os.path.join(bucket_path, "pack_index.csv")
+            indexed = load_pack_index(pack_index) if os.path.isfile(pack_index) else {}
+            remaining = chunk
+        else:
+            indexed = {}
+            moved_paths = {row["File Path"] for row in moved}
+            remaining = [row for row in chunk if row["File Path"] not in moved_paths]
+        for row in moved:
+            if row["File Path"] not in indexed and not os.path.exists(os.path.join(bucket_path, "assets", row["File Path"])):
+                raise FileNotFoundError(f"Missing from origin and {bucket}: {row['File Path']}")
+
+        print(f"Resuming bucket: {bucket_path}")
+        if archiver.layout == "pack":
+            for row in remaining:
+                origin_filepath = os.path.join(row["Origin"], row["File Path"])
+                if os.path.exists(origin_filepath):
+                    os.remove(origin_filepath)
+        else:
+            write_data(remaining, os.path.join(bucket_path, "assets"), archiver.order)
+        return True
+
+    def stage_bucket(self, bucket):
+        """Verifies a finished bucket and hands it on to Staging"""
+        bucket_path = os.path.join(self.directories["Chunking"], bucket)
+        staging_path = os.path.join(self.directories["Staging"], bucket)
+        try:
+            if not os.path.isdir(bucket_path):
+                return
+            if os.path.exists(staging_path):
+                print(f"Already in {STAGES['Staging']}, leaving in place: {bucket_path}")
+                return
+            if not verify_file_manifest(os.path.join(bucket_path, "file_manifest.csv")):
+                print(f"Bucket failed verification, leaving in place: {bucket_path}")
+                self.unverified.add(bucket)
+                return
+            with self.lock:
+                # Another staging worker may have got here first
+                if os.path.exists(staging_path) or not os.path.isdir(bucket_path):
+                    return
+                shutil.move(bucket_path, staging_path)
+            print(f"Staged: {bucket}")
+        finally:
+            with self.lock:
+                self.queued.discard(("Chunking", bucket))
+
+    def serve(self, work_queue, handler):
+        """Runs handler on queued work until stop() is called. A failed item is reported and left where it is."""
+        while not self.stop_event.is_set():
+            try:
+                item = work_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                handler(item)
+            except Exception as e:
+                print(f"Failed on {item}: {e}")
+            finally:
+                work_queue.task_done()
+
+    def watcher(self):
+        while not self.stop_event.is_set():
+            self.poll()
+            self.stop_event.wait(self.poll_interval)
+
+    def start(self):
+        # Chunking has one worker so bucket numbering and seen md5 stay consistent
+        workers = [(self.watcher, ()), (self.serve, (self.chunk_queue, self.chunk_folder))]
+        workers += [(self.serve, (self.manifest_queue, self.manifest_folder))] * self.manifest_workers
+        workers += [(self.serve, (self.staging_queue, self.stage_bucket))] * self.staging_workers
+        for worker, args in workers:
+            thread = threading.Thread(target=worker, args=args, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self):
+        print(f"Watching {self.root}")
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Stopping")
+            self.stop()
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python ingest.py <pipeline root> (optional) <bucket size in bytes> <settle seconds>")
+        sys.exit(1)
+
+    args = sys.argv[1:]
+    kwargs = {}
+    if len(args) > 1:
+        kwargs["bucket_size"] = int(args[1])
+    if len(args) > 2:
+        kwargs["settle_seconds"] = float(args[2])
+    IngestDaemon(args[0], **kwargs).run()
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,14 @@ import csv
 import hashlib
 from datetime import datetime
 import sys
+import archiver
+from profiler import StageProfiler
 
 class Manifest:
-    def __init__(self, source):
+    def __init__(self, source, order = "path", profile = None):
         self.source = source
+        self.order = order
+        self.profiler = StageProfiler(profile, "manifest")
         self.parent_directory = os.path.dirname(self.source)
         self.output_csv = os.path.join(self.parent_directory, 'file_manifest.csv')
         self.header = ['File Path', 'Bytes', 'MD5', 'Timestamp']
@@ -20,15 +24,33 @@ class Manifest:
             csv_writer = csv.writer(csv_file)
             csv_writer.writerow(self.header)
 
-            for dirpath, dirnames, filenames in os.walk(self.source):
-                dirnames.sort()
-                for filename in sorted(filenames):
-                    if not filename.startswith('.'):
-                        file_path = os.path.join(dirpath, filename)
+            if self.order == "path":
+                for file_path in self.walk_files():
+                    with self.profiler.stage("hash"):
                         file_info = self.get_file_info(file_path, self.source)
+                    with self.profiler.stage("write"):
                         csv_writer.writerow(file_info)
+            else:
+                # Hash in physical order, write in path order
+                file_paths = list(self.walk_files())
+                file_infos = {}
+                for file_path in archiver.sort_by_locality(file_paths, self.order):
+                    with self.profiler.stage("hash"):
+                        file_infos[file_path] = self.get_file_info(file_path, self.source)
+                with self.profiler.stage("write"):
+                    for file_path in file_paths:
+                        csv_writer.writerow(file_infos[file_path])
 
-            return self.output_csv
+        self.profiler.report()
+        return self.output_csv
+
+    def walk_files(self):
+        """Yields the file paths under source in sorted path order, skipping hidden files"""
+        for dirpath, dirnames, filenames in self.profiler.iterate("walk", os.walk(self.source)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.startswith('.'):
+                    yield os.path.join(dirpath, filename)
 
     def calculate_md5(self, file_path, block_size=65536):
         """Calculate md5 checksum from file path"""
@@ -52,54 +74,82 @@ class Manifest:
         Params: path to file_manifest.csv
         Returns True if the manifest is valid
         """
-        if expected_header:
-            expected_header = self.header
+        try:
+            if expected_header:
+                expected_header = self.header
 
-        asset_folder = os.path.join(os.path.dirname(csv_file), 'assets')
-        if not os.path.isdir(asset_folder):
-            print("No asset folder found.")
-            return False
+            asset_folder = os.path.join(os.path.dirname(csv_file), 'assets')
+            if not os.path.isdir(asset_folder):
+                # Packed buckets keep their data in packs/ with an offset index
+                if os.path.isfile(os.path.join(os.path.dirname(csv_file), 'pack_index.csv')):
+                    return archiver.verify_file_manifest(csv_file, expected_header, self.order)
+                print("No asset folder found.")
+                return False
         
 
-        with open(csv_file, mode='r', newline='') as temp_csv_file:
-            csv_reader = csv.reader(temp_csv_file)
-            header = next(csv_reader)  # Skip the header row, checking first
-            if expected_header and expected_header != header:
-                print("Header mismatch found.")
-                return False
+            with open(csv_file, mode='r', newline='') as temp_csv_file:
+                csv_reader = csv.reader(temp_csv_file)
+                header = next(csv_reader)  # Skip the header row, checking first
+                if expected_header and expected_header != header:
+                    print("Header mismatch found.")
+                    return False
 
-        # print(csv_file, type(csv_file))
+            # print(csv_file, type(csv_file))
 
-        with open(csv_file, newline='', encoding='utf-8') as f:
-            csv_reader = csv.DictReader(f)
+            with open(csv_file, newline='', encoding='utf-8') as f:
+                csv_reader = csv.DictReader(f)
 
-            for row in csv_reader:
-                csv_asset_file_path = row["File Path"]
-                csv_md5 = row["MD5"]
-                file_path = os.path.join(asset_folder, csv_asset_file_path)
-                if not os.path.exists(file_path):
-                    print(f'"File missing: "{file_path}')
-                    return False
-                current_md5 = self.calculate_md5(file_path)
-                if current_md5 != csv_md5:
-                    print(f'"MD5 mismatch: "{file_path}')
-                    return False
+                # Hash everything up front in physical order, then report in manifest order
+                current_md5s = {}
+                if self.order != "path":
+                    with self.profiler.stage("parse"):
+                        csv_reader = list(csv_reader)
+                    file_paths = [os.path.join(asset_folder, row["File Path"]) for row in csv_reader]
+                    for file_path in archiver.sort_by_locality(file_paths, self.order):
+                        if os.path.exists(file_path):
+                            with self.profiler.stage("hash"):
+                                current_md5s[file_path] = self.calculate_md5(file_path)
+
+                for row in (csv_reader if self.order != "path" else self.profiler.iterate("parse", csv_reader)):
+                    csv_asset_file_path = row["File Path"]
+                    csv_md5 = row["MD5"]
+                    file_path = os.path.join(asset_folder, csv_asset_file_path)
+                    if not os.path.exists(file_path):
+                        print(f'"File missing: "{file_path}')
+                        return False
+                    if file_path in current_md5s:
+                        current_md5 = current_md5s[file_path]
+                    else:
+                        with self.profiler.stage("hash"):
+                            current_md5 = self.calculate_md5(file_path)
+                    if current_md5 != csv_md5:
+                        print(f'"MD5 mismatch: "{file_path}')
+                        return False
                     
-        return True
+            return True
+        finally:
+            self.profiler.report()
     
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python manifest.py <asset folder or manifest>")
+    # --order and --profile need a value after them
+    if len(sys.argv) < 2 or sys.argv[-1] in ("--order", "--profile"):
+        print("Usage: python manifest.py <asset folder or manifest> (optional) --order <path|inode|extent> --profile <report dir>")
         sys.exit(1)
     else:
+        order = "path"
+        if "--order" in sys.argv:
+            order = sys.argv[sys.argv.index("--order") + 1]
+        profile = None
+        if "--profile" in sys.argv:
+            profile = sys.argv[sys.argv.index("--profile") + 1]
         for i in sys.argv:
             if os.path.isfile(i) and i.endswith('file_manifest.csv'):
                 print(f"Verifying manifest: {i}")
-                this_manifest = Manifest(i)
+                this_manifest = Manifest(i, order, profile)
                 result = this_manifest.verify_file_manifest(i, expected_header = False)
                 print(f"Manifest valid: {result}")
             if os.path.isdir(i) and i.endswith('assets'):
-                this_manifest = Manifest(i)
+                this_manifest = Manifest(i, order, profile)
                 this_manifest.generate_file_manifest()
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Per-stage cProfile and tracemalloc reports for the --profile option of manifest.py, chunker.py and Archiver.
+import os
+import csv
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+NULL_STAGE = nullcontext()
+
+class StageProfiler:
+    def __init__(self, output_dir = None, label = "profile", top_allocations = 10):
+        """
+        Profiles named stages (walk, hash, load, parse, group, write, move) separately.
+        Stages may nest, time and allocations are counted against the innermost stage only.
+        Does nothing when output_dir is None, so it can stay in the hot loops.
+
+        :param output_dir: string, dir to write the reports to, None to disable profiling
+        :param label: string, prefix for the report files
+        :param top_allocations: integer, number of allocation sites listed per stage
+        """
+        self.output_dir = output_dir
+        self.enabled = output_dir is not None
+        self.label = f"{label}_{time.strftime('%y%m%d%H%M%S')}"
+        self.top_allocations = top_allocations
+        self.stages = {}
+        self.stack = []
+        self.started_tracemalloc = False
+        # cProfile only sees the thread that enables it, so other threads are not profiled
+        self.thread_id = threading.get_ident()
+
+    def stage(self, name):
+        """Context manager around one pass through a stage"""
+        if not self.enabled or threading.get_ident() != self.thread_id:
+            return NULL_STAGE
+        return self.profile_stage(name)
+
+    def iterate(self, name, iterable):
+        """Wraps an iterable so the time spent producing each item counts against a stage"""
+        if not self.enabled or threading.get_ident() != self.thread_id:
+            return iterable
+        return self.profile_iterable(name, iterable)
+
+    def profile_iterable(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.profile_stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def profile_stage(self, name):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        stage = self.stages.setdefault(name, {"Profile": cProfile.Profile(), "Calls": 0, "Seconds": 0.0, "Peak Bytes": 0, "Snapshot": None, "Snapshot Peak": 0})
+
+        # Pause the outer stage
+        if self.stack:
+            outer = self.stack[-1]
+            outer["Profile"].disable()
+            self.record_peak(outer)
+        self.stack.append(stage)
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        stage["Profile"].enable()
+        try:
+            yield
+        finally:
+            stage["Profile"].disable()
+            stage["Seconds"] += time.perf_counter() - start
+            stage["Calls"] += 1
+            self.record_peak(stage)
+            self.record_snapshot(stage)
+            self.stack.pop()
+
+            # Resume the outer stage
+            tracemalloc.reset_peak()
+            if self.stack:
+                self.stack[-1]["Profile"].enable()
+
+    def record_peak(self, stage):
+        """Keeps the highest traced memory seen in a stage"""
+        peak = tracemalloc.get_traced_memory()[1]
+        if peak > stage["Peak Bytes"]:
+            stage["Peak Bytes"] = peak
+
+    def record_snapshot(self, stage):
+        """
+        Snapshots where a stage's memory went, once per stage plus again only if its peak has grown by a quarter.
+        A snapshot copies every live trace, so taking one per pass would make profiling cost grow with the square of the rows.
+        """
+        if stage["Snapshot"] is None or stage["Peak Bytes"] > stage["Snapshot Peak"] * 1.25:
+            stage["Snapshot"] = tracemalloc.take_snapshot()
+            stage["Snapshot Peak"] = stage["Peak Bytes"]
+
+    def report(self):
+        """Writes <label>_<stage>.prof, <label>_<stage>_memory.txt and <label>_summary.csv, then clears the stages"""
+        if not self.enabled or not self.stages:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Several runs can start within the same second, never overwrite an earlier report
+        label = self.label
+        run_num = 1
+        while os.path.exists(os.path.join(self.output_dir, f"{self.label}_summary.csv")):
+            run_num += 1
+            self.label = f"{label}-{run_num}"
+        rows = []
+        for name, stage in self.stages.items():
+            prof_file = os.path.join(self.output_dir, f"{self.label}_{name}.prof")
+            stage["Profile"].create_stats()
+            pstats.Stats(stage["Profile"]).dump_stats(prof_file)
+
+            memory_file = os.path.join(self.output_dir, f"{self.label}_{name}_memory.txt")
+            with open(memory_file, "w", encoding='utf-8') as f:
+                f.write(f"Stage: {name}\n")
+                f.write(f"Peak traced bytes: {stage['Peak Bytes']}\n")
+                if stage["Snapshot"] is not None:
+                    f.write(f"Top {self.top_allocations} allocation sites when traced memory was {stage['Snapshot Peak']} bytes:\n")
+                    for stat in stage["Snapshot"].statistics('lineno')[:self.top_allocations]:
+                        f.write(f"{stat}\n")
+
+            rows.append({"Stage": name, "Calls": stage["Calls"], "Seconds": round(stage["Seconds"], 6), "Peak Bytes": stage["Peak Bytes"]})
+
+        summary_csv = os.path.join(self.output_dir, f"{self.label}_summary.csv")
+        with open(summary_csv, "w", newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=["Stage", "Calls", "Seconds", "Peak Bytes"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        # Start the next report from scratch so it only covers what ran after this one
+        self.stages = {}
+        self.stack = []
+        for row in rows:
+            print(f"{row['Stage']}: {row['Calls']} calls, {row['Seconds']}s, peak {round(row['Peak Bytes'] / 1000 ** 2, 2)} MB")
+        print(f"Profile written: {summary_csv}")
+        return summary_csv
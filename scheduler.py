@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import csv
+import lzma
+import zlib
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from archiver import calculate_md5, load_pack_index, read_packed_file
+
+# Errors that mean the destination is out of room, anything else fails the bucket only
+CAPACITY_ERRORS = {errno.ENOSPC, getattr(errno, "EDQUOT", errno.ENOSPC)}
+
+class Scheduler:
+    def __init__(self, archiver, destinations, placement_csv_name = "placement_map.csv"):
+        """
+        Spreads the buckets of an Archiver across several destination roots, one mover per destination
+
+        :param archiver: Archiver object, used for grouping and writing buckets
+        :param destinations: list of destination roots, or (root, free bytes) tuples. Free bytes defaults to the free space on the drive
+        :param placement_csv_name: string, name of the placement map written to every destination root
+        """
+        self.archiver = archiver
+        self.placement_csv_name = placement_csv_name
+        self.destinations = []
+        for destination in destinations:
+            if isinstance(destination, (tuple, list)):
+                root, free_bytes = destination
+            else:
+                root, free_bytes = destination, None
+            os.makedirs(root, exist_ok=True)
+            if free_bytes is None:
+                free_bytes = shutil.disk_usage(root).free
+            self.destinations.append({"Root": str(root), "Free": int(free_bytes), "Full": False, "Failed": False})
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.placements = []
+        self.failed = []
+
+    def run(self):
+        print(f"Scheduling to {[d['Root'] for d in self.destinations]}")
+        self.archiver.groups, self.archiver.dupes, self.archiver.oversized = self.archiver.group_files()
+
+        # Buckets keep the number they would get from Archiver.write_chunks
+        self.pending = [(i, chunk, sum(int(row["Bytes"]) for row in chunk)) for i, chunk in enumerate(self.archiver.groups, self.archiver.start_num)]
+
+        # A failed destination hands its bucket back, so keep going while anyone has room
+        while self.pending:
+            open_destinations = [d for d in self.destinations if not d["Full"]]
+            if not open_destinations:
+                break
+            with ThreadPoolExecutor(max_workers=len(open_destinations)) as executor:
+                for future in [executor.submit(self.mover, d) for d in open_destinations]:
+                    future.result()
+
+        self.placements.sort(key=lambda placement: placement["Bucket"])
+        self.write_placement_map()
+
+        self.unplaced = [self.archiver.bucket_name(i) for i, _, _ in self.pending]
+        if self.unplaced:
+            print(f"Unplaced buckets, no destination has room: {self.unplaced}")
+        for failure in self.failed:
+            print(f"Failed bucket {failure['Bucket']} on {failure['Destination']}: {failure['Error']}")
+        return self.placements
+
+    def next_bucket(self, destination):
+        """Takes the first pending bucket that fits the destination and reserves its space"""
+        with self.lock:
+            if destination["Full"]:
+                return None
+            for index, (i, chunk, size) in enumerate(self.pending):
+                if size <= destination["Free"]:
+                    destination["Free"] -= size
+                    return self.pending.pop(index)
+            destination["Full"] = True
+            return None
+
+    def mover(self, destination):
+        """Writes buckets to one destination until nothing pending fits"""
+        while True:
+            bucket = self.next_bucket(destination)
+            if bucket is None:
+                print(f"Destination done: {destination['Root']}")
+                return
+            i, chunk, size = bucket
+            try:
+                self.archiver.write_bucket(i, chunk, destination["Root"])
+            except OSError as e:
+                print(f"Write failed on {destination['Root']}: {e}")
+                self.rollback_bucket(i, chunk, destination["Root"])
+                if e.errno not in CAPACITY_ERRORS:
+                    # Source side or other errors are not the destination's fault, keep it open
+                    with self.lock:
+                        destination["Free"] += size
+                        self.failed.append({"Bucket": self.archiver.bucket_name(i), "Destination": destination["Root"], "Error": str(e)})
+                    continue
+                # Target filled up early, hand the bucket back to the other destinations
+                with self.lock:
+                    destination["Full"] = True
+                    destination["Failed"] = True
+                    for other in self.destinations:
+                        if not other["Failed"]:
+                            other["Full"] = False
+                    self.pending.append(bucket)
+                    self.pending.sort(key=lambda pending_bucket: pending_bucket[0])
+                return
+            with self.lock:
+                self.placements.append({"Bucket": self.archiver.bucket_name(i), "Destination": destination["Root"], "Bytes": size, "Files": len(chunk)})
+
+    def rollback_bucket(self, i, chunk, root):
+        """
+        Puts any already moved files back in their origin and removes the partial bucket.
+        Packed sources are only removed once pack_index.csv is written, so they are restored from the packs.
+        If a file cannot be put back the partial bucket is left in place rather than lose its data.
+        """
+        bucket_path = os.path.join(root, self.archiver.bucket_name(i))
+        index_csv = os.path.join(bucket_path, "pack_index.csv")
+        pack_index = load_pack_index(index_csv) if os.path.isfile(index_csv) else {}
+        lost = []
+        for row in chunk:
+            origin_filepath = os.path.join(row["Origin"], row["File Path"])
+            if os.path.exists(origin_filepath):
+                continue
+            moved_filepath = os.path.join(bucket_path, "assets", row["File Path"])
+            try:
+                os.makedirs(os.path.dirname(origin_filepath), exist_ok=True)
+                if os.path.exists(moved_filepath):
+                    shutil.move(moved_filepath, origin_filepath)
+                elif row["File Path"] in pack_index:
+                    with open(origin_filepath, 'wb') as f:
+                        for block in read_packed_file(os.path.join(bucket_path, "packs"), pack_index[row["File Path"]]):
+                            f.write(block)
+                    if calculate_md5(origin_filepath) != row["MD5"]:
+                        os.remove(origin_filepath)
+                        lost.append(origin_filepath)
+            except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+                print(f"Rollback failed for {origin_filepath}: {e}")
+                lost.append(origin_filepath)
+        if lost:
+            print(f"Could not restore {len(lost)} files, leaving partial bucket in place: {bucket_path}")
+            return False
+        shutil.rmtree(bucket_path, ignore_errors=True)
+        return True
+
+    def write_placement_map(self):
+        """Writes the placement map to every destination root so any drive can point to the rest"""
+        for destination in self.destinations:
+            filename = os.path.join(destination["Root"], self.placement_csv_name)
+            with open(filename, "w", newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=["Bucket", "Destination", "Bytes", "Files"])
+                writer.writeheader()
+                writer.writerows(self.placements)
+            print(f"Written placement map to {filename}")
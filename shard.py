@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Sharded manifest generation. A plan splits the asset tree into contiguous path ranges, each shard is hashed
+# into a partial manifest by its own process or host, and merge streams the partials into file_manifest.csv.
+import os
+import csv
+import sys
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from manifest import Manifest
+
+def walk_key(relative_path):
+    """
+    Sort key matching the order Manifest.generate_file_manifest writes rows in:
+    files in a folder come before its sub folders, each sorted by name
+    """
+    parts = relative_path.split(os.sep)
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+def walk_files(source, first_key = None, end_key = None):
+    """
+    Yields (relative path, file path) in walk order, limited to first_key <= walk_key < end_key.
+    Folders that fall entirely outside the range are not walked.
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative_dir = os.path.relpath(dirpath, source)
+        dir_key = () if relative_dir == '.' else tuple((1, part) for part in relative_dir.split(os.sep))
+        # Keep only the sub folders that can hold keys inside the range
+        kept_dirnames = []
+        for dirname in sorted(dirnames):
+            sub_key = dir_key + ((1, dirname),)
+            if first_key is not None and sub_key < first_key[:len(sub_key)]:
+                continue
+            if end_key is not None and sub_key > end_key[:len(sub_key)]:
+                continue
+            kept_dirnames.append(dirname)
+        dirnames[:] = kept_dirnames
+
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            relative_path = filename if relative_dir == '.' else os.path.join(relative_dir, filename)
+            key = walk_key(relative_path)
+            if first_key is not None and key < first_key:
+                continue
+            if end_key is not None and key >= end_key:
+                continue
+            yield relative_path, os.path.join(dirpath, filename)
+
+class ShardedManifest:
+    def __init__(self, source):
+        self.source = source
+        self.parent_directory = os.path.dirname(self.source)
+        self.output_csv = os.path.join(self.parent_directory, 'file_manifest.csv')
+        self.plan_csv = os.path.join(self.parent_directory, 'shard_plan.csv')
+        self.header = ['File Path', 'Bytes', 'MD5', 'Timestamp']
+
+    def partial_csv(self, shard_num):
+        return os.path.join(self.parent_directory, f'file_manifest.shard-{str(shard_num).zfill(4)}.csv')
+
+    def plan(self, shard_count):
+        """
+        Splits the tree into up to shard_count contiguous path ranges of roughly equal bytes.
+        Only stats files, nothing is hashed. The first shard has no lower bound so files added
+        later are never dropped, and each shard ends where the next one starts.
+
+        :param shard_count: integer, number of shards
+        """
+        files = [(relative_path, os.path.getsize(file_path)) for relative_path, file_path in walk_files(self.source)]
+        total_bytes = sum(size for _, size in files)
+        shards = []
+        shard_bytes = 0
+        for index, (relative_path, size) in enumerate(files):
+            # Start a new shard once this one has its share, leaving the rest to the remaining shards
+            if not shards or (shard_bytes >= total_bytes / shard_count and len(shards) < shard_count):
+                shards.append({"Shard": len(shards) + 1, "First Path": "" if not shards else relative_path, "Files": 0, "Bytes": 0})
+                shard_bytes = 0
+            shards[-1]["Files"] += 1
+            shards[-1]["Bytes"] += size
+            shard_bytes += size
+
+        with open(self.plan_csv, "w", newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=["Shard", "First Path", "Files", "Bytes"])
+            writer.writeheader()
+            writer.writerows(shards)
+        print(f"Planned {len(shards)} shards: {self.plan_csv}")
+        return len(shards)
+
+    def load_plan(self):
+        with open(self.plan_csv, newline='', encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+
+    def hash_shard(self, shard_num):
+        """
+        Hashes one shard of the plan into its partial manifest. Safe to run on any host that mounts the same tree.
+
+        :param shard_num: integer, shard number from the plan, starting at 1
+        """
+        shards = self.load_plan()
+        first_path = shards[shard_num - 1]["First Path"]
+        end_path = shards[shard_num]["First Path"] if shard_num < len(shards) else ""
+        first_key = walk_key(first_path) if first_path else None
+        end_key = walk_key(end_path) if end_path else None
+
+        manifest = Manifest(self.source)
+        partial_csv = self.partial_csv(shard_num)
+        with open(partial_csv, mode='w', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(self.header)
+            for relative_path, file_path in walk_files(self.source, first_key, end_key):
+                csv_writer.writerow(manifest.get_file_info(file_path, self.source))
+        print(f"Shard {shard_num} written: {partial_csv}")
+        return partial_csv
+
+    def merge(self, keep_partials = False):
+        """Streams the partial manifests into a single file_manifest.csv in walk order"""
+        partial_csvs = [self.partial_csv(int(shard["Shard"])) for shard in self.load_plan()]
+        missing = [partial_csv for partial_csv in partial_csvs if not os.path.isfile(partial_csv)]
+        if missing:
+            print(f"Partial manifests missing: {missing}")
+            return None
+
+        files = [open(partial_csv, newline='') for partial_csv in partial_csvs]
+        try:
+            readers = []
+            for f in files:
+                reader = csv.reader(f)
+                header = next(reader)
+                if header != self.header:
+                    print(f"Header mismatch found: {f.name}")
+                    return None
+                readers.append(reader)
+
+            with open(self.output_csv, mode='w', newline='') as csv_file:
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(self.header)
+                csv_writer.writerows(heapq.merge(*readers, key=lambda row: walk_key(row[0])))
+        finally:
+            for f in files:
+                f.close()
+
+        if not keep_partials:
+            for partial_csv in partial_csvs:
+                os.remove(partial_csv)
+        print(f"Merged {len(partial_csvs)} shards: {self.output_csv}")
+        return self.output_csv
+
+def hash_shard(source, shard_num):
+    return ShardedManifest(source).hash_shard(shard_num)
+
+def generate_file_manifest(source, shard_count, processes = None):
+    """
+    Plans, hashes every shard in its own process and merges, standing in for running shards on several hosts
+
+    :param source: string, asset folder to manifest
+    :param shard_count: integer, number of shards
+    :param processes: integer, number of worker processes (defaults to shard_count)
+    """
+    sharded_manifest = ShardedManifest(source)
+    shard_count = sharded_manifest.plan(shard_count)
+    with ProcessPoolExecutor(max_workers=processes or shard_count or 1) as executor:
+        list(executor.map(hash_shard, [source] * shard_count, range(1, shard_count + 1)))
+    return sharded_manifest.merge()
+
+def main():
+    usage = ("Usage: python shard.py plan <asset folder> <shard count>\n"
+             "       python shard.py hash <asset folder> <shard number>\n"
+             "       python shard.py merge <asset folder>\n"
+             "       python shard.py run <asset folder> <shard count> (optional) <processes>")
+    if len(sys.argv) < 3:
+        print(usage)
+        sys.exit(1)
+
+    command, source = sys.argv[1], sys.argv[2]
+    if command == "plan" and len(sys.argv) > 3:
+        ShardedManifest(source).plan(int(sys.argv[3]))
+    elif command == "hash" and len(sys.argv) > 3:
+        ShardedManifest(source).hash_shard(int(sys.argv[3]))
+    elif command == "merge":
+        ShardedManifest(source).merge()
+    elif command == "run" and len(sys.argv) > 3:
+        processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        generate_file_manifest(source, int(sys.argv[3]), processes)
+    else:
+        print(usage)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
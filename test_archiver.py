@@ -1,8 +1,52 @@
 import unittest
 import os
+import errno
 import shutil
+import time
+import asyncio
+import csv
+import pstats
+from unittest import mock
 from archiver import Archiver
 from archiver import Manifest
+from archiver import verify_file_manifest, restore_packed_file, sort_by_locality, write_data, calculate_md5
+from scheduler import Scheduler
+from async_pipeline import AsyncManifest, LocalFS
+from async_pipeline import write_data as async_write_data
+import manifest as manifest_module
+from ingest import IngestDaemon
+import shard
+from shard import ShardedManifest
+
+class LatencyFS(LocalFS):
+    """Local filesystem stand-in that sleeps before every call, like a high-latency network mount"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def listdir(self, path):
+        time.sleep(self.latency)
+        return super().listdir(path)
+
+    def stat(self, file_path):
+        time.sleep(self.latency)
+        return super().stat(file_path)
+
+    def exists(self, file_path):
+        time.sleep(self.latency)
+        return super().exists(file_path)
+
+    def calculate_md5(self, file_path, block_size=65536):
+        time.sleep(self.latency)
+        return super().calculate_md5(file_path, block_size)
+
+    def copy(self, old_filepath, new_filepath):
+        time.sleep(self.latency)
+        return super().copy(old_filepath, new_filepath)
+
+    def move(self, old_filepath, new_filepath):
+        time.sleep(self.latency)
+        return super().move(old_filepath, new_filepath)
 
 class TestArchiver(unittest.TestCase):
     """Basic test cases."""
@@ -67,6 +111,374 @@ class TestArchiver(unittest.TestCase):
         null = input("PAUSED")
 
 
+    def test_Archiver_pack(self):
+        print("---Testing Packed Archiver---")
+        manifest = Manifest(os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets"))
+        manifest.generate_file_manifest()
+        archiver = Archiver([manifest.output_csv], output_dir= self.directories["Chunking"], bucket_size= 50, seen_md5=set(), layout="pack", pack_size= 20, compression="zlib")
+        archiver.run()
+
+        for i in range(1, len(archiver.groups) + 1):
+            bucket_path = os.path.join(self.directories["Chunking"], f"BDL-{str(i).zfill(4)}")
+            assert(not os.path.exists(os.path.join(bucket_path, "assets")))
+            assert(verify_file_manifest(os.path.join(bucket_path, "file_manifest.csv")) == True)
+
+        # Restore a single file with a seek
+        bucket_path = os.path.join(self.directories["Chunking"], "BDL-0001")
+        file_path = archiver.groups[0][-1]["File Path"]
+        restored = restore_packed_file(bucket_path, file_path, os.path.join(self.test_root, "restored.txt"))
+        with open(restored, 'rb') as f:
+            assert(f.read() == b'\0' * int(archiver.groups[0][-1]["Bytes"]))
+
+        # Corrupt a pack and verify it fails
+        pack = os.path.join(bucket_path, "packs", "PACK-0001.pak")
+        with open(pack, 'r+b') as f:
+            f.write(b'garbage')
+        assert(verify_file_manifest(os.path.join(bucket_path, "file_manifest.csv")) == False)
+
+    def test_Scheduler(self):
+        print("---Testing Scheduler---")
+        manifest = Manifest(os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets"))
+        manifest.generate_file_manifest()
+        archiver = Archiver([manifest.output_csv], bucket_size= 50, seen_md5=set())
+        destinations = [(os.path.join(self.directories["Staging"], "DriveA"), 100), (os.path.join(self.directories["Staging"], "DriveB"), 60)]
+        scheduler = Scheduler(archiver, destinations)
+        placements = scheduler.run()
+
+        assert(len(placements) == len(archiver.groups))
+        assert(scheduler.unplaced == [])
+        for destination, limit in destinations:
+            assert(sum(p["Bytes"] for p in placements if p["Destination"] == destination) <= limit)
+            assert(os.path.isfile(os.path.join(destination, "placement_map.csv")))
+        for placement in placements:
+            bucket_manifest = os.path.join(placement["Destination"], placement["Bucket"], "file_manifest.csv")
+            assert(verify_file_manifest(bucket_manifest) == True)
+
+    def test_Scheduler_errors(self):
+        print("---Testing Scheduler Errors---")
+        manifest = Manifest(os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets"))
+        manifest.generate_file_manifest()
+        drive_a = os.path.join(self.directories["Staging"], "DriveA")
+        drive_b = os.path.join(self.directories["Staging"], "DriveB")
+
+        # A missing source file fails its bucket only, the destinations stay open
+        os.remove(os.path.join(manifest.source, "TestFiles_10bytes", "TestFiles_10bytes_2.txt"))
+        archiver = Archiver([manifest.output_csv], bucket_size= 50, seen_md5=set())
+        scheduler = Scheduler(archiver, [(drive_a, 1000), (drive_b, 1000)])
+        placements = scheduler.run()
+        assert([failure["Bucket"] for failure in scheduler.failed] == ["BDL-0001"])
+        assert(scheduler.unplaced == [])
+        assert([p["Bucket"] for p in placements] == ["BDL-0002", "BDL-0003"])
+        assert(not any(d["Failed"] for d in scheduler.destinations))
+        assert(os.path.isfile(os.path.join(manifest.source, "TestFiles_10bytes", "TestFiles_10bytes_0.txt")))
+
+        # Running out of space hands the bucket to the other destination
+        shutil.rmtree(drive_a)
+        shutil.rmtree(drive_b)
+        os.remove(os.path.join(manifest.source, "TestFiles_10bytes", "TestFiles_10bytes_0.txt"))
+        manifest.generate_file_manifest()
+        archiver = Archiver([manifest.output_csv], bucket_size= 50, seen_md5=set())
+        write_bucket = archiver.write_bucket
+        def full_drive_a(i, chunk, output_dir):
+            if output_dir == drive_a:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            return write_bucket(i, chunk, output_dir)
+        archiver.write_bucket = full_drive_a
+        scheduler = Scheduler(archiver, [(drive_a, 1000), (drive_b, 1000)])
+        placements = scheduler.run()
+        assert(scheduler.failed == [] and scheduler.unplaced == [])
+        assert([p["Bucket"] for p in placements] == ["BDL-0001"])
+        assert(placements[0]["Destination"] == drive_b)
+
+        # A packed bucket that fails part way through removing its sources restores them from the packs
+        shutil.rmtree(drive_a)
+        shutil.rmtree(drive_b)
+        manifest.generate_file_manifest()
+        with open(manifest.output_csv, newline='') as f:
+            rows = list(csv.DictReader(f))
+        archiver = Archiver([manifest.output_csv], bucket_size= 1000, seen_md5=set(), layout="pack", compression="zlib")
+        remove = os.remove
+        removed = []
+        def busy_third_remove(file_path):
+            if len(removed) == 2:
+                raise OSError(errno.EBUSY, "Device or resource busy", file_path)
+            removed.append(file_path)
+            remove(file_path)
+        with mock.patch("archiver.os.remove", side_effect=busy_third_remove):
+            scheduler = Scheduler(archiver, [(drive_a, 1000)])
+            placements = scheduler.run()
+        assert(placements == [] and [failure["Bucket"] for failure in scheduler.failed] == ["BDL-0001"])
+        assert(not os.path.exists(os.path.join(drive_a, "BDL-0001")))
+        for row in rows:
+            assert(calculate_md5(os.path.join(manifest.source, row["File Path"])) == row["MD5"])
+
+    def test_Manifest_locality_order(self):
+        print("---Testing Locality Order---")
+        manifest = Manifest(os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets"))
+        manifest.generate_file_manifest()
+        with open(manifest.output_csv) as f:
+            path_ordered = f.read()
+
+        for order in ("inode", "extent"):
+            manifest = Manifest(manifest.source, order=order)
+            manifest.generate_file_manifest()
+            with open(manifest.output_csv) as f:
+                assert(f.read() == path_ordered)
+
+        file_paths = list(manifest.walk_files())
+        assert(sorted(sort_by_locality(file_paths, "extent")) == sorted(file_paths))
+        def inode_key(file_path):
+            stat = os.stat(file_path)
+            return (stat.st_dev, stat.st_ino)
+        inode_ordered = sorted(file_paths, key=inode_key)
+        assert(sort_by_locality(file_paths, "inode") == inode_ordered)
+        assert(sort_by_locality(list(reversed(file_paths)), "inode") == inode_ordered)
+
+        # write_data reads the sources in inode order
+        rows = [{"File Path": os.path.relpath(file_path, manifest.source), "Origin": manifest.source, "Bytes": "1"} for file_path in file_paths]
+        moved = []
+        with mock.patch("archiver.shutil.move", side_effect=lambda old_filepath, new_filepath: moved.append(old_filepath)):
+            write_data(rows, os.path.join(self.directories["Chunking"], "assets"), order="inode")
+        assert(moved == inode_ordered)
+
+        # Verify reports the first failure in manifest order
+        assert(verify_file_manifest(manifest.output_csv, order="inode") == True)
+        os.remove(file_paths[-1])
+        assert(verify_file_manifest(manifest.output_csv, order="inode") == False)
+
+    def test_AsyncManifest(self):
+        print("---Testing Async Manifest---")
+        source = os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets")
+        os.makedirs(os.path.join(source, "TestFiles_10bytes", "nested"), exist_ok=True)
+        with open(os.path.join(source, "TestFiles_10bytes", "nested", "nested.txt"), 'wb') as f:
+            f.write(b'\0' * 3)
+        manifest = manifest_module.Manifest(source)
+        manifest.generate_file_manifest()
+        with open(manifest.output_csv) as f:
+            expected = f.read()
+        os.remove(manifest.output_csv)
+
+        latency = 0.02
+        async_manifest = AsyncManifest(source, concurrency=16, fs=LatencyFS(latency))
+        start = time.time()
+        asyncio.run(async_manifest.generate_file_manifest())
+        elapsed = time.time() - start
+        with open(async_manifest.output_csv) as f:
+            assert(f.read() == expected)
+        # 16 files with a stat and a read each would take ~0.64s one at a time
+        assert(elapsed < 16 * 2 * latency / 2)
+
+        assert(asyncio.run(async_manifest.verify_file_manifest(async_manifest.output_csv)) == True)
+        with open(os.path.join(source, "TestFiles_15bytes", "TestFiles_15bytes_2.txt"), 'wb') as f:
+            f.write(b'\1')
+        assert(asyncio.run(async_manifest.verify_file_manifest(async_manifest.output_csv)) == False)
+
+    def test_async_write_data(self):
+        print("---Testing Async Copy and Move---")
+        source = os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets")
+        manifest = manifest_module.Manifest(source)
+        manifest.generate_file_manifest()
+        with open(manifest.output_csv, newline='') as f:
+            rows = [dict(row, Origin=source) for row in csv.DictReader(f)]
+
+        latency = 0.02
+        fs = LatencyFS(latency)
+        copy_path = os.path.join(self.directories["Chunking"], "copy", "assets")
+        start = time.time()
+        asyncio.run(async_write_data(rows, copy_path, mode="copy", concurrency=16, fs=fs))
+        assert(time.time() - start < len(rows) * latency / 2)
+        shutil.copy(manifest.output_csv, os.path.dirname(copy_path))
+        assert(verify_file_manifest(os.path.join(os.path.dirname(copy_path), "file_manifest.csv")) == True)
+        assert(all(os.path.isfile(os.path.join(source, row["File Path"])) for row in rows))
+
+        move_path = os.path.join(self.directories["Chunking"], "move", "assets")
+        asyncio.run(async_write_data(rows, move_path, mode="move", concurrency=16, fs=fs))
+        shutil.copy(manifest.output_csv, os.path.dirname(move_path))
+        assert(verify_file_manifest(os.path.join(os.path.dirname(move_path), "file_manifest.csv")) == True)
+        assert(not any(os.path.exists(os.path.join(source, row["File Path"])) for row in rows))
+
+    def wait_for(self, condition, timeout=10):
+        start = time.time()
+        while not condition():
+            assert(time.time() - start < timeout)
+            time.sleep(0.05)
+
+    def test_IngestDaemon(self):
+        print("---Testing Ingest Daemon---")
+        def land(name, contents):
+            folder_path = os.path.join(self.directories["Landing"], name, "assets")
+            os.makedirs(folder_path, exist_ok=True)
+            for i, content in enumerate(contents):
+                with open(os.path.join(folder_path, f"{name}_{i}.txt"), 'wb') as f:
+                    f.write(content)
+
+        staging = self.directories["Staging"]
+        land("Shoot1", [bytes([i]) * 10 for i in range(6)])
+        daemon = IngestDaemon(self.test_root, bucket_size=50, settle_seconds=0, poll_interval=0.05)
+        daemon.start()
+        self.wait_for(lambda: len(os.listdir(staging)) == 2)
+        daemon.stop()
+        assert(sorted(os.listdir(staging)) == ["BDL-0001", "BDL-0002"])
+        assert(os.path.isfile(os.path.join(self.directories["ToChunk"], "Shoot1", "file_manifest.csv")))
+
+        # A restarted daemon keeps numbering and dedupes against what it has already seen
+        land("Shoot2", [bytes([0]) * 10, bytes([9]) * 10])
+        daemon = IngestDaemon(self.test_root, bucket_size=50, settle_seconds=0, poll_interval=0.05)
+        daemon.start()
+        self.wait_for(lambda: len(os.listdir(staging)) == 3)
+        daemon.stop()
+        assert(verify_file_manifest(os.path.join(staging, "BDL-0003", "file_manifest.csv")) == True)
+        assert(os.path.isfile(os.path.join(self.directories["ToChunk"], "Shoot2", "duplicates.csv")))
+
+    def test_IngestDaemon_resume(self):
+        print("---Testing Ingest Daemon Resume---")
+        folder_path = os.path.join(self.directories["Landing"], "Shoot1", "assets")
+        os.makedirs(folder_path, exist_ok=True)
+        for i in range(6):
+            with open(os.path.join(folder_path, f"Shoot1_{i}.txt"), 'wb') as f:
+                f.write(bytes([i]) * 10)
+        daemon = IngestDaemon(self.test_root, bucket_size=30)
+        daemon.manifest_folder("Shoot1")
+
+        # Crash part way through the second bucket, after one of its files has moved
+        write_bucket = Archiver.write_bucket
+        def crash_on_second_bucket(archiver, i, chunk, output_dir):
+            if i == 2:
+                write_data(chunk[:1], os.path.join(output_dir, archiver.bucket_name(i), "assets"))
+                raise OSError("Simulated crash")
+            return write_bucket(archiver, i, chunk, output_dir)
+        with mock.patch.object(Archiver, "write_bucket", crash_on_second_bucket):
+            with self.assertRaises(OSError):
+                daemon.chunk_folder("Shoot1")
+        assert(daemon.state["seen_md5"] == set())
+        assert(daemon.state["next_bucket"] == 3)
+        assert("Shoot1" not in daemon.state["chunked"])
+        assert(("ToChunk", "Shoot1") not in daemon.queued)
+        daemon.stage_bucket("BDL-0001")
+
+        # A restarted daemon finishes the same buckets instead of regrouping
+        daemon = IngestDaemon(self.test_root, bucket_size=30)
+        daemon.chunk_folder("Shoot1")
+        daemon.stage_bucket("BDL-0002")
+        staging = self.directories["Staging"]
+        assert(sorted(os.listdir(staging)) == ["BDL-0001", "BDL-0002"])
+        for bucket in ("BDL-0001", "BDL-0002"):
+            assert(verify_file_manifest(os.path.join(staging, bucket, "file_manifest.csv")) == True)
+        assert(len(daemon.state["seen_md5"]) == 6)
+        assert(daemon.state["in_progress"] == {})
+
+        # Never stage onto a bucket that is already there
+        shutil.copytree(os.path.join(staging, "BDL-0001"), os.path.join(self.directories["Chunking"], "BDL-0001"))
+        daemon.stage_bucket("BDL-0001")
+        assert(not os.path.exists(os.path.join(staging, "BDL-0001", "BDL-0001")))
+        assert(os.path.isdir(os.path.join(self.directories["Chunking"], "BDL-0001")))
+
+    def test_IngestDaemon_restart(self):
+        print("---Testing Ingest Daemon Restart---")
+        folder_path = os.path.join(self.directories["Landing"], "Shoot1", "assets")
+        os.makedirs(folder_path, exist_ok=True)
+        for i in range(6):
+            with open(os.path.join(folder_path, f"Shoot1_{i}.txt"), 'wb') as f:
+                f.write(bytes([i]) * 10)
+
+        # A manifest that fails once is tried again instead of being skipped for good
+        daemon = IngestDaemon(self.test_root, bucket_size=30, settle_seconds=0, poll_interval=0.05, staging_workers=0)
+        generate_file_manifest = manifest_module.Manifest.generate_file_manifest
+        calls = []
+        def fail_once(manifest):
+            calls.append(manifest.source)
+            if len(calls) == 1:
+                raise OSError("Simulated read error")
+            return generate_file_manifest(manifest)
+        with mock.patch.object(manifest_module.Manifest, "generate_file_manifest", fail_once):
+            daemon.start()
+            self.wait_for(lambda: "Shoot1" in daemon.state["chunked"])
+            daemon.stop()
+        assert(len(calls) == 2)
+        assert(daemon.queued == {("Chunking", "BDL-0001"), ("Chunking", "BDL-0002")})
+
+        # Buckets chunked before the daemon stopped are staged by the next one
+        staging = self.directories["Staging"]
+        assert(os.listdir(staging) == [])
+        daemon = IngestDaemon(self.test_root, bucket_size=30, settle_seconds=0, poll_interval=0.05)
+        daemon.start()
+        self.wait_for(lambda: len(os.listdir(staging)) == 2)
+        daemon.stop()
+        assert(sorted(os.listdir(staging)) == ["BDL-0001", "BDL-0002"])
+        assert(os.listdir(self.directories["Chunking"]) == [])
+        assert(daemon.queued == set())
+
+    def test_ShardedManifest(self):
+        print("---Testing Sharded Manifest---")
+        source = os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets")
+        os.makedirs(os.path.join(source, "TestFiles_10bytes", "nested"), exist_ok=True)
+        for filename in ("root.txt", os.path.join("TestFiles_10bytes", "nested", "nested.txt")):
+            with open(os.path.join(source, filename), 'wb') as f:
+                f.write(b'\1' * 7)
+        manifest = manifest_module.Manifest(source)
+        manifest.generate_file_manifest()
+        with open(manifest.output_csv) as f:
+            expected = f.read()
+        os.remove(manifest.output_csv)
+
+        output_csv = shard.generate_file_manifest(source, 3, processes=3)
+        with open(output_csv) as f:
+            assert(f.read() == expected)
+        assert(not os.path.exists(ShardedManifest(source).partial_csv(1)))
+
+        # Shards run out of order and merge still streams them back into walk order
+        sharded_manifest = ShardedManifest(source)
+        shard_count = sharded_manifest.plan(4)
+        for shard_num in reversed(range(1, shard_count + 1)):
+            sharded_manifest.hash_shard(shard_num)
+        os.remove(output_csv)
+        sharded_manifest.merge()
+        with open(output_csv) as f:
+            assert(f.read() == expected)
+
+    def test_profile(self):
+        print("---Testing Profile---")
+        profile_dir = os.path.join(self.test_root, "profile")
+        manifest = manifest_module.Manifest(os.path.join(self.test_root, "02_ToChunk", "TestFiles", "assets"), profile=profile_dir)
+        manifest.generate_file_manifest()
+        generate_summary = os.path.join(profile_dir, f"{manifest.profiler.label}_summary.csv")
+
+        # A second report from the same instance only covers what ran after the first
+        assert(manifest.verify_file_manifest(manifest.output_csv) == True)
+        with open(os.path.join(profile_dir, f"{manifest.profiler.label}_summary.csv"), newline='') as f:
+            verify_stages = {row["Stage"]: row for row in csv.DictReader(f)}
+        assert(sorted(verify_stages) == ["hash", "parse"])
+        assert(int(verify_stages["hash"]["Calls"]) == 15)
+        os.remove(os.path.join(profile_dir, f"{manifest.profiler.label}_summary.csv"))
+
+        # The ordered verify parses the manifest once, in a single stage
+        verify_dir = os.path.join(self.test_root, "profile_verify")
+        verify_manifest = manifest_module.Manifest(manifest.source, order="inode", profile=verify_dir)
+        assert(verify_manifest.verify_file_manifest(manifest.output_csv) == True)
+        summary = [filename for filename in os.listdir(verify_dir) if filename.endswith("_summary.csv")][0]
+        with open(os.path.join(verify_dir, summary), newline='') as f:
+            verify_stages = {row["Stage"]: row for row in csv.DictReader(f)}
+        assert(int(verify_stages["parse"]["Calls"]) == 1)
+        assert(int(verify_stages["hash"]["Calls"]) == 15)
+
+        archiver = Archiver([manifest.output_csv], output_dir= self.directories["Chunking"], bucket_size= 50, seen_md5=set(), profile=profile_dir)
+        archiver.run()
+
+        stages = {}
+        for filename in os.listdir(profile_dir):
+            if filename.endswith("_summary.csv"):
+                with open(os.path.join(profile_dir, filename), newline='') as f:
+                    stages[filename.split("_")[0]] = {row["Stage"]: row for row in csv.DictReader(f)}
+        assert(sorted(stages["manifest"]) == ["hash", "walk", "write"])
+        assert(sorted(stages["archiver"]) == ["group", "move", "parse", "write"])
+        assert(int(stages["manifest"]["hash"]["Calls"]) == 15)
+        # One pass per row plus the end of file read of the one csv
+        assert(int(stages["archiver"]["parse"]["Calls"]) == 16)
+        assert(os.path.isfile(generate_summary))
+
+        prof_files = [filename for filename in os.listdir(profile_dir) if filename.startswith("archiver_") and filename.endswith("_move.prof")]
+        assert(pstats.Stats(os.path.join(profile_dir, prof_files[0])).total_calls > 0)
+
     def test_calculate_md5(self):
         print("---Testing MD5---")
         manifest = Manifest("No Path")